@@ -1,18 +1,47 @@
 import os
 import openai
-import concurrent.futures
+import asyncio
+import json
 import pandas as pd
 import logging
-import copy
 
+from collections import defaultdict
 from typing import Dict, List, Optional
+from urllib.parse import urlparse
 
 from dotenv import load_dotenv
-from src import ChatGPTCrawler
+from src import ChatGPTCrawler, WebCrawlerPool, close_session
 
 logger = logging.getLogger('main')
 
-PROMPT_TEMPLATE_FIND_CONTACTS = """
+# shows the browsers and lets you chat with ChatGPT during the initial search
+DEBUG = False
+# maximum number of browsers running at the same time, only pages rendered by JavaScript need one
+MAX_BROWSERS = 8
+# contacts on the same domain are looked up together by one client, at most this many at a time
+MAX_CONTACTS_PER_CLIENT = 5
+# the initial search only needs to find the right subpages, so it runs on a cheaper model
+FIND_CONTACTS_MODEL = "gpt-4o-mini"
+
+# contact fields and the labels they are logged with
+CONTACT_LOG_COLUMNS = {
+    'name': 'Name',
+    'political_party': 'Partei',
+    'position': 'Position',
+    'email': 'Email',
+    'phone': 'Telefon',
+    'contact_url': 'Website',
+    'address': 'Adresse',
+    'additional_info': 'Zusätzliche Infos',
+}
+CONTACT_LOG_FORMAT = ", ".join(label + ": %s" for label in CONTACT_LOG_COLUMNS.values())
+
+
+def prompt_find_contacts(url: str) -> str:
+    """
+    Builds the prompt for the initial search on a start url
+    """
+    return f"""
          I am trying to find the people responsible for transport policy on a website.
          If they are found, they should be saved.
          Usually there are several people on a site and they belong to one party.
@@ -20,10 +49,20 @@ PROMPT_TEMPLATE_FIND_CONTACTS = """
          Here is the url: {url}
         """
 
-PROMPT_TEMPLATE_UPDATE_CONTACTS = """
-        I am trying to find information about this person on a website.
-        When you have found the information, you want it to be saved.
-        Here is the person: {person} and the url: {contact_url}
+
+def prompt_update_contacts(contacts: List[Dict[str, Optional[str]]]) -> str:
+    """
+    Builds the prompt for the detailed search of several people on their subpages
+    """
+    people = json.dumps(
+        [{"name": contact["name"], "contact_url": contact["contact_url"]} for contact in contacts],
+        ensure_ascii=False,
+    )
+    return f"""
+        I am trying to find information about these people on a website.
+        When you have found the information about a person, you want it to be saved.
+        Save every person separately.
+        Here are the people with their urls: {people}
         """
 
 
@@ -50,48 +89,14 @@ def setup():
 
 def check_for_subpages(contacts: List[Dict[str, Optional[str]]]):
     """
-    Checks if one contact from the list is missing a contacts_url and if contacts is empty
-
-    Returns: True if every contact in the list has an url
-    """
-    contacts_tmp = copy.deepcopy(contacts)
-    for contact in contacts_tmp:
-        if contact['contact_url'] is None:
-            logger.warning('Für den Kontakt ' + contact['name'] + 'wurde keine Unterseite gefunden. ')
-            contacts_tmp.remove(contact)
-    return contacts_tmp
-
-
-def deduplicate_contacts(contacts: List[Dict[str, Optional[str]]]):
-    """
-    Removes all duplicate contacts from a list by Name
+    Checks which contacts from the list are missing a contact_url and logs them
 
-    Return: The changed list of contacts
+    Returns: a new list with only the contacts that have an url
     """
-    contacts_set = set()
-    unique_contacts = []
-
     for contact in contacts:
-        if contact['name'] not in contacts_set:
-            unique_contacts.append(contact)
-            contacts_set.add(contact['name'])
-
-    return unique_contacts
-
-
-def replace_none_with_unbekannt(
-        contacts: List[Dict[str, Optional[str]]]
-) -> List[Dict[str, str]]:
-    """
-    Replaces every None value in a list with "Unbekannt"
-
-    Returns: the changed list
-    """
-    for contact in contacts:
-        for key in contact:
-            if contact[key] is None:
-                contact[key] = "Unbekannt"
-    return contacts
+        if contact['contact_url'] is None:
+            logger.warning('Für den Kontakt %s wurde keine Unterseite gefunden.', contact['name'])
+    return [contact for contact in contacts if contact['contact_url'] is not None]
 
 
 def merge_contact_lists(
@@ -125,82 +130,79 @@ def merge_contact_lists(
     return list(merged_contacts.values())
 
 
-def find_contacts(url: str) -> List[Dict[str, str]]:
+async def find_contacts(url: str, pool: WebCrawlerPool) -> List[Dict[str, str]]:
     """
     Main logic to find a contact
     """
-    debug = False
-    client = ChatGPTCrawler(debug)
+    client = ChatGPTCrawler(DEBUG, model=FIND_CONTACTS_MODEL, webcrawler=pool)
     client.attach(update)
-    contacts = client.start(PROMPT_TEMPLATE_FIND_CONTACTS, url=url)
-    logger.info(f"Tokens used: input {client.input_tokens_used}, output {client.output_tokens_used}")
+    contacts = await client.start(prompt_find_contacts(url), start_url=url)
+    logger.info("Tokens used: input %s, output %s", client.input_tokens_used, client.output_tokens_used)
     logger.info("Found contacts:")
-    logger.info(contacts)
-
-    contacts_from_first_search = copy.deepcopy(deduplicate_contacts(contacts))
+    logger.info("%s", contacts)
 
     if not contacts:
-        logger.info("Bei der Suche für die Seite " + url + " wurden keine Kontakte gefunden")
+        logger.info("Bei der Suche für die Seite %s wurden keine Kontakte gefunden", url)
         return contacts
     logger.info("Bei der initialen Suche wurden folgende Kontakte gefunden:")
-    contacts_copy = copy.deepcopy(contacts)
-    replace_none_with_unbekannt(contacts_copy)
-    for contact in contacts_copy:
-        logger.info(f"Name: {contact['name']}, "
-                    f"Partei: {contact['political_party']}, "
-                    f"Position: {contact['position']}, "
-                    f"Email: {contact['email']}, "
-                    f"Telefon: {contact['phone']}, "
-                    f"Website: {contact['contact_url']}, "
-                    f"Adresse: {contact['address']}, "
-                    f"Zusätzliche Infos: {contact['additional_info']}")
+    for contact in contacts:
+        logger.info(CONTACT_LOG_FORMAT, *(contact[field] for field in CONTACT_LOG_COLUMNS))
 
     # check if every contact in contacts has a contact_url
-    contacts_tmp = copy.deepcopy(check_for_subpages(contacts))
+    contacts_tmp = check_for_subpages(contacts)
     if contacts_tmp:
         client.reset()
-        update_contacts(contacts_tmp)
-        contacts.extend(contacts_tmp)
-        contacts = deduplicate_contacts(contacts)
-        merge_contact_lists(contacts_from_first_search, contacts)
+        updated_contacts = await update_contacts(contacts_tmp, pool, url)
+        # merging by name also removes duplicates, the rest is deduplicated once in run()
+        contacts = merge_contact_lists(contacts, updated_contacts)
     return contacts
 
 
-def update_contacts(
-        contacts: List[Dict[str, Optional[str]]]
+async def update_contacts(
+        contacts: List[Dict[str, Optional[str]]],
+        pool: WebCrawlerPool,
+        start_url: str,
 ) -> List[Dict[str, Optional[str]]]:
     """
     Looks for further contact information on a given subpage
+    The updated contacts get the start_url of the search they were found in
 
     Return: a List with all updated contacts
     """
     logger.info("Unterseiten werden jetzt für zusätzliche Informationen durchsucht.")
     contacts_list = []
 
-    # optionally limit number of Threads with max_workers=x
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-        future_to_contact = {executor.submit(update_contact, contact): contact for contact in contacts}
-        for future in concurrent.futures.as_completed(future_to_contact):
-            for contact in future.result():
-                contacts_list.append(contact)
+    # contacts on the same domain share one conversation, so the prompt prefix and pages are reused
+    contacts_by_domain = defaultdict(list)
+    for contact in contacts:
+        contacts_by_domain[urlparse(contact["contact_url"]).netloc].append(contact)
+    batches = [
+        domain_contacts[i:i + MAX_CONTACTS_PER_CLIENT]
+        for domain_contacts in contacts_by_domain.values()
+        for i in range(0, len(domain_contacts), MAX_CONTACTS_PER_CLIENT)
+    ]
+
+    results = await asyncio.gather(*[update_contact_batch(batch, pool, start_url) for batch in batches])
+    for result in results:
+        contacts_list.extend(result)
     return contacts_list
 
 
-def update_contact(contact: Dict[str, Optional[str]]) -> List[Dict[str, Optional[str]]]:
+async def update_contact_batch(
+        contacts: List[Dict[str, Optional[str]]],
+        pool: WebCrawlerPool,
+        start_url: str,
+) -> List[Dict[str, Optional[str]]]:
     """
-    Creates a new client and looks for a single contact on a subpage using the PROMPT_TEMPLATE_UPDATE_CONTACTS
+    Creates a new client and looks for several contacts on their subpages using prompt_update_contacts
 
-    Returns: a single contact
+    Returns: the contacts found
     """
-    client = ChatGPTCrawler()
+    client = ChatGPTCrawler(webcrawler=pool)
     client.attach(update)
-    detailed_contact = client.start(
-        PROMPT_TEMPLATE_UPDATE_CONTACTS,
-        person=contact["name"],
-        contact_url=contact["contact_url"],
-    )
-    logger.info(detailed_contact)
-    return detailed_contact
+    detailed_contacts = await client.start(prompt_update_contacts(contacts), start_url=start_url)
+    logger.info("%s", detailed_contacts)
+    return detailed_contacts
 
 
 def update(state):
@@ -209,42 +211,43 @@ def update(state):
     """
     if state is not None:
         the_url = state
-        logger.info('Rufe ' + str(the_url) + ' auf.')
+        logger.info('Rufe %s auf.', the_url)
 
 
-def run(urls: List[str]) -> pd.DataFrame:
+async def run(urls: List[str]) -> pd.DataFrame:
     """
     Starts the search for contacts on the given urls
     will return a pandas dataframe with all contacts found
     """
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(find_contacts, url) for url in urls]
+    pool = WebCrawlerPool(size=MAX_BROWSERS, headless=not DEBUG)
+    try:
+        results = await asyncio.gather(
+            *[find_contacts(url, pool) for url in urls],
+            return_exceptions=True,
+        )
+    finally:
+        pool.close()
+        await close_session()
 
     contacts = []
-    for future in concurrent.futures.as_completed(futures):
-        try:
-            result = future.result()
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Beim durchsuchen ist folgender Fehler aufgetreten: %s", result)
+        else:
             contacts.extend(result)
-        except Exception as e:
-            logger.error(f"Beim durchsuchen ist folgender Fehler aufgetreten: {e}")
 
     if not contacts:
         logger.info("Keine Kontakte gefunden.")
 
-    replace_none_with_unbekannt(contacts)
+    df = pd.DataFrame(contacts)
+    if not df.empty:
+        df = df.drop_duplicates(subset=['name', 'start_url'])
+    df = df.fillna("Unbekannt")
 
-    for contact in contacts:
-        logger.info(f"Name: {contact['name']}, "
-                    f"Partei: {contact['political_party']}, "
-                    f"Position: {contact['position']}, "
-                    f"Email: {contact['email']}, "
-                    f"Telefon: {contact['phone']}, "
-                    f"Website: {contact['contact_url']}, "
-                    f"Adresse: {contact['address']}, "
-                    f"Zusätzliche Infos: {contact['additional_info']}")
+    # one log record for all contacts, only rendered if it is actually logged
+    if not df.empty and logger.isEnabledFor(logging.INFO):
+        logger.info("\n%s", df[list(CONTACT_LOG_COLUMNS)].rename(columns=CONTACT_LOG_COLUMNS).to_string(index=False))
 
-    df = pd.DataFrame(contacts)
     df['last_updated'] = pd.Timestamp.now()
     return df
 
@@ -253,7 +256,7 @@ def run_df(df: pd.DataFrame) -> pd.DataFrame:
     # look at unique start links (start_url) column
     urls = df.start_url.unique()
     # run
-    df = run(urls)
+    df = asyncio.run(run(urls))
     return df
 
 
@@ -262,21 +265,12 @@ def merge_original_and_updated_df(original_df: pd.DataFrame, updated_df: pd.Data
     Merges the original and updated contact dataframes together, ensuring that updated_df rows appear before original_df rows
     for each unique start_url. Then, sorts the merged dataframe by 'start_url'.
     """
-    # Add a temporary column to indicate the source of each row
-    original_df['source'] = 1  # 1 indicates rows from the original dataframe
-    updated_df['source'] = 0  # 0 indicates rows from the updated dataframe
-
-    # Merge the dataframes
-    merged_df = pd.concat([original_df, updated_df], ignore_index=True)
-
-    # Drop duplicates based on 'name' and 'start_url', keeping the last occurrence
-    merged_df = merged_df.drop_duplicates(subset=['name', 'start_url'], keep='last')
-
-    # Sort by 'start_url' and then by 'source' to ensure updated_df rows appear first
-    merged_df = merged_df.sort_values(by=['start_url', 'source'])
+    # Put the updated rows first, so they win over the original rows with the same 'name' and 'start_url'
+    merged_df = pd.concat([updated_df, original_df], ignore_index=True)
+    merged_df = merged_df.drop_duplicates(subset=['name', 'start_url'], keep='first')
 
-    # Optionally, remove the temporary 'source' column if it's no longer needed
-    merged_df = merged_df.drop(columns=['source'])
+    # A stable sort keeps the updated rows in front of the original rows of each 'start_url'
+    merged_df = merged_df.sort_values(by='start_url', kind='stable')
 
     return merged_df
 
@@ -1 +1,2 @@
-from .chatgpt import ChatGPTCrawler
\ No newline at end of file
+from .chatgpt import ChatGPTCrawler
+from .crawler import WebCrawlerPool, close_session
@@ -0,0 +1,28 @@
+import hashlib
+import json
+from functools import lru_cache
+
+import diskcache
+
+LLM_CACHE_DIR = "./.llm_cache"
+WEB_CACHE_DIR = "./.web_cache"
+WEB_CACHE_EXPIRE = 7 * 24 * 60 * 60  # cleaned pages are fetched again after a week
+
+
+@lru_cache(maxsize=None)
+def open_cache(directory):
+    """
+    Opens the disk cache in the given directory, every caller of the same directory shares one instance
+    """
+    return diskcache.Cache(directory)
+
+
+def completion_key(model, messages, tools):
+    """
+    Builds the cache key of a chat completion request
+
+    Returns: a hex digest of the model, messages and tool signatures
+    """
+    tools_sig = json.dumps(tools, sort_keys=True)
+    payload = json.dumps({"model": model, "messages": messages, "tools_sig": tools_sig}, sort_keys=True)
+    return hashlib.blake2b(payload.encode("utf-8")).hexdigest()
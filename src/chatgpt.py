@@ -1,10 +1,19 @@
+import asyncio
+import inspect
 import json
 from collections import OrderedDict
 
 import logging
-from openai import OpenAI
+import backoff
+import openai
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion
+from w3lib.url import canonicalize_url
 
-from .crawler import WebCrawler
+from .caching import LLM_CACHE_DIR, WEB_CACHE_DIR, WEB_CACHE_EXPIRE, completion_key, open_cache
+from .crawler import WebCrawler, clean_html_content, extract_contact_blocks
+from .ratelimit import throttle
+from .tokens import truncate_tokens
 
 
 class Cache(OrderedDict):
@@ -14,32 +23,57 @@ class Cache(OrderedDict):
 
     def __setitem__(self, key, value):
         if key in self:
-            del self[key]
+            self.move_to_end(key)
         elif len(self) == self.max_capacity:
             self.popitem(last=False)
         OrderedDict.__setitem__(self, key, value)
 
     def __getitem__(self, key):
-        if key in self:
-            value = OrderedDict.__getitem__(self, key)
-            del self[key]
-            OrderedDict.__setitem__(self, key, value)
-            return value
-        else:
-            raise KeyError(key)
+        value = OrderedDict.__getitem__(self, key)
+        self.move_to_end(key)
+        return value
+
+
+# the same first message for every conversation, together with the tools it forms a constant
+# prefix that OpenAI's automatic prompt caching can reuse across requests
+SYSTEM_INSTRUCTIONS = (
+    "You are a web crawler that searches the websites of political parties and parliaments for contacts. "
+    "Use visit_url to load pages and follow their links, and save_contact to save every person you are asked for "
+    "together with all contact information the pages provide. Only save information that is found on the pages."
+)
 
 
 class ChatGPTDone(Exception):
     pass
 
 
+# tools without side effects, only these are started while the completion is still streamed.
+# a failed stream is retried, and a contact saved from it would be saved a second time
+STREAMED_TOOLS = ("visit_url",)
+
+# errors worth retrying, everything else (e.g. BadRequestError) is raised immediately
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+def _log_retry(details):
+    logging.warning(
+        "OpenAI request failed with %r, retry %s in %.1fs",
+        details['exception'], details['tries'], details['wait'],
+    )
+
+
+# schemas of all functions decorated with register_tool, filled when the class body is executed
 def register_tool(description, params):
     def decorator(func):
         def wrapper(self, *args, **kwargs):
             return func(self, *args, **kwargs)
 
         # Set metadata without causing recursion
-        wrapper.is_tool = True
         wrapper.tool_metadata = {
             "name": func.__name__,
             "description": description,
@@ -55,13 +89,36 @@ def register_tool(description, params):
     return decorator
 
 
+def collect_tools(cls):
+    # runs once when the class is defined, only the tools registered on this class end up in its list
+    cls._TOOLS = [
+        # sorted keys, so every request serializes the tools to the same bytes
+        json.loads(json.dumps({"type": "function", "function": attr.tool_metadata}, sort_keys=True))
+        for attr in vars(cls).values() if hasattr(attr, 'tool_metadata')
+    ]
+    return cls
+
+
+@collect_tools
 class ChatGPTCrawler():
+    _TOOLS = []
+
+    @property
+    def tools(self):
+        return self._TOOLS
+
     def __init__(
             self,
             debug=False,
             verbose=False,
             model="gpt-4-1106-preview",
             web_cache_size=16,
+            api_timeout=30,
+            llm_cache_dir=LLM_CACHE_DIR,
+            web_cache_dir=WEB_CACHE_DIR,
+            webcrawler=None,
+            max_html_tokens=8000,
+            max_page_messages=2,
     ) -> None:
         super().__init__()
         self.model = model
@@ -76,38 +133,42 @@ class ChatGPTCrawler():
         self._observers = []
         self._state = None
 
-        self.webcrawler = WebCrawler(
+        # tool calls already started while the completion was streamed, by tool call id
+        self._tool_tasks = {}
+
+        # a shared webcrawler or a WebCrawlerPool is not closed by this client
+        self._owns_webcrawler = webcrawler is None
+        self.webcrawler = webcrawler if webcrawler is not None else WebCrawler(
             headless=not self.debug
         )
-        self.api = OpenAI()
+        # retries are handled by _create_completion, not by the SDK
+        self.api = AsyncOpenAI(timeout=api_timeout, max_retries=0)
 
         self.web_cache = Cache(max_capacity=web_cache_size)
+        # cleaned pages shared by all clients and runs, None disables it
+        self.page_cache = open_cache(web_cache_dir) if web_cache_dir is not None else None
+        # pages returned by visit_url are cut down to this many tokens, None disables it
+        self.max_html_tokens = max_html_tokens
+        # only the latest pages stay in the conversation, older ones are replaced by a short note
+        self.max_page_messages = max_page_messages
+        self._page_messages = []  # (index in messages, url) of every page still sent in full
+        # completions are deterministic (seed + temperature 0), so replay them from disk; None disables it
+        self.llm_cache = open_cache(llm_cache_dir) if llm_cache_dir is not None else None
 
         self.start_url = None
         self.total_tokens_used = 0
         self.input_tokens_used = 0
         self.output_tokens_used = 0
 
-    @property
-    def tools(self):
-        tool_methods = []
-        for attr_name in dir(self):
-            # Skip the 'tools' property and other special methods or properties
-            if attr_name in ['tools', '__class__', '__module__', '__doc__'] or attr_name.startswith('__'):
-                continue
-
-            attr = getattr(self, attr_name)
-            if callable(attr) and getattr(attr, 'is_tool', False):
-                tool_methods.append({
-                    "type": "function",
-                    "function": attr.tool_metadata
-                })
-        return tool_methods
-
-    def start(self, prompt_templates, **prompt_kwargs):
-        self.start_url = prompt_kwargs.get('url', None)
-        # Start prompt
-        start_prompt = prompt_templates.format(**prompt_kwargs)
+    async def start(self, start_prompt, start_url=None):
+        self.start_url = start_url
+        if not self.messages:
+            self.messages.append(
+                {
+                    "role": "system",
+                    "content": SYSTEM_INSTRUCTIONS
+                }
+            )
         self.messages.append(
             {
                 "role": "user",
@@ -116,7 +177,7 @@ class ChatGPTCrawler():
         )
         while True:
             try:
-                self._step()
+                await self._step()
             except ChatGPTDone:
                 break
         # return contacts
@@ -126,18 +187,24 @@ class ChatGPTCrawler():
         self.messages = []
         self.completions = []
         self.contacts = []
+        self._tool_tasks = {}
+        self._page_messages = []
         self.start_url = None
         self.total_tokens_used = 0
         self.input_tokens_used = 0
         self.output_tokens_used = 0
         # TODO: craweler reset?
 
+    def close(self):
+        if self._owns_webcrawler:
+            self.webcrawler.close()
+
     """
     Private methods
     """
 
-    def _step(self):
-        comp = self._chat_gpt_api_request()
+    async def _step(self):
+        comp = await self._chat_gpt_api_request()
         comp = comp.choices[0]
         message = comp.message
         if message is None:
@@ -146,7 +213,7 @@ class ChatGPTCrawler():
             raise ChatGPTDone
 
         # check if function call
-        if self._handle_function_call(message):
+        if await self._handle_function_call(message):
             # return so in the next step chat gpt can handle the function calls
             return
 
@@ -155,7 +222,7 @@ class ChatGPTCrawler():
             raise ChatGPTDone
 
         # is a regular chat message
-        logging.info(f"ChatGPT:\n{message.content}")
+        logging.info("ChatGPT:\n%s", message.content)
         logging.info('')
         user_input = input("You ('q' to stop): ")
         if user_input == 'q':
@@ -167,17 +234,23 @@ class ChatGPTCrawler():
             }
         )
 
-    def _handle_function_call(self, message):
+    async def _handle_function_call(self, message):
         if message.tool_calls is None:
             return False
 
-        # append all tool call results to the messages
+        pending = []
         for tool_call in message.tool_calls:
+            task = self._tool_tasks.pop(tool_call.id, None)
+            if task is None:
+                # not started while streaming, i.e. a tool with side effects or a completion from the cache
+                task = self._run_tool(tool_call.function.name, tool_call.function.arguments)
+            pending.append(task)
+        # the tool calls are independent, so e.g. several pages are loaded at the same time
+        outputs = await asyncio.gather(*pending)
+
+        # append all tool call results to the messages, in the order chatgpt called the tools
+        for tool_call, output in zip(message.tool_calls, outputs):
             tool = tool_call.function
-            args = json.loads(tool.arguments)
-
-            output = getattr(self, tool.name)(**args)
-
             self.messages.append(
                 {
                     "role": "function",
@@ -185,13 +258,71 @@ class ChatGPTCrawler():
                     "name": tool.name,
                 }
             )
+            if tool.name == "visit_url":
+                self._page_messages.append((len(self.messages) - 1, json.loads(tool.arguments).get("url")))
+                self._shorten_old_pages()
 
         return True
 
-    def _chat_gpt_api_request(self, prompt=None):
+    def _shorten_old_pages(self):
+        # every request resends the whole conversation, so old pages would be paid for again on every turn
+        while len(self._page_messages) > self.max_page_messages:
+            index, url = self._page_messages.pop(0)
+            message = self.messages[index]
+            self.messages[index] = {
+                **message,
+                "content": f"[visited {url}, returned {len(message['content'])} chars]",
+            }
+
+    async def _run_tool(self, name, arguments):
+        output = getattr(self, name)(**json.loads(arguments))
+        if inspect.isawaitable(output):
+            output = await output
+        return output
+
+    def _dispatch_tool_call(self, tool_call):
+        if tool_call["function"]["name"] not in STREAMED_TOOLS:
+            return
+        # start the tool right away, so it runs while the rest of the completion is still streamed
+        self._tool_tasks[tool_call["id"]] = asyncio.create_task(
+            self._run_tool(tool_call["function"]["name"], tool_call["function"]["arguments"])
+        )
+
+    async def _chat_gpt_api_request(self, prompt=None):
         if prompt is not None:
             self.messages += [{"role": "user", "content": prompt}]
-        completion = self.api.chat.completions.create(
+        if self.llm_cache is not None:
+            cache_key = completion_key(self.model, self.messages, self.tools)
+            cached = self.llm_cache.get(cache_key)
+            if cached is not None:
+                completion = ChatCompletion.construct(**cached)
+                self.completions.append(completion)
+                return completion
+
+        completion = await self._create_completion()
+
+        if completion.usage is not None:
+            self.total_tokens_used += completion.usage.total_tokens
+            self.input_tokens_used += completion.usage.prompt_tokens
+            self.output_tokens_used += completion.usage.completion_tokens
+        self.completions.append(completion)
+        if self.llm_cache is not None:
+            self.llm_cache.set(cache_key, completion.model_dump())
+        
+        return completion
+
+    @backoff.on_exception(
+        backoff.expo,
+        RETRYABLE_ERRORS,
+        max_tries=6,
+        base=1.5,  # grow the wait by 150% per try ...
+        factor=30,  # ... starting at 30 seconds
+        jitter=None,  # full jitter (the default) could retry right away into the same rate limit window
+        on_backoff=_log_retry,
+    )
+    async def _create_completion(self):
+        await throttle(self.model, self.messages)
+        stream = await self.api.chat.completions.create(
           model=self.model,
           messages=self.messages,
           tools=self.tools,
@@ -199,14 +330,66 @@ class ChatGPTCrawler():
           seed=42,
           temperature=0.0, # make it deterministic
           #top_p=0.00001, # make it (more) deterministic
+          stream=True,
+          stream_options={"include_usage": True},
         )
 
-        self.total_tokens_used += completion.usage.total_tokens
-        self.input_tokens_used += completion.usage.prompt_tokens
-        self.output_tokens_used += completion.usage.completion_tokens
-        self.completions.append(completion)
-        
-        return completion
+        dispatched = set(self._tool_tasks)
+        try:
+            return await self._collect_stream(stream)
+        except Exception:
+            # the request is retried, so drop the tool calls started from this attempt
+            for tool_call_id in set(self._tool_tasks) - dispatched:
+                self._tool_tasks.pop(tool_call_id).cancel()
+            raise
+
+    async def _collect_stream(self, stream):
+        # merge the chunks into a ChatCompletion and start every tool call as soon as it is complete
+        content = []
+        tool_calls = []
+        finish_reason = None
+        usage = None
+        chunk = None
+        async for chunk in stream:
+            if chunk.usage is not None:
+                # sent in an extra chunk without choices at the end of the stream
+                usage = chunk.usage.model_dump()
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta.content:
+                content.append(choice.delta.content)
+            for delta in choice.delta.tool_calls or []:
+                if delta.index == len(tool_calls):
+                    # a new tool call starts, so the previous one is complete
+                    if tool_calls:
+                        self._dispatch_tool_call(tool_calls[-1])
+                    tool_calls.append({"id": delta.id, "type": "function", "function": {"name": "", "arguments": ""}})
+                if delta.function is not None:
+                    tool_calls[delta.index]["function"]["name"] += delta.function.name or ""
+                    tool_calls[delta.index]["function"]["arguments"] += delta.function.arguments or ""
+            if choice.finish_reason is not None:
+                finish_reason = choice.finish_reason
+        if tool_calls:
+            self._dispatch_tool_call(tool_calls[-1])
+
+        return ChatCompletion.construct(
+            id=chunk.id,
+            object="chat.completion",
+            created=chunk.created,
+            model=chunk.model,
+            system_fingerprint=chunk.system_fingerprint,
+            choices=[{
+                "index": 0,
+                "finish_reason": finish_reason,
+                "message": {
+                    "role": "assistant",
+                    "content": "".join(content) or None,
+                    "tool_calls": tool_calls or None,
+                },
+            }],
+            usage=usage,
+        )
 
     """
     TOOLS for ChatGPT
@@ -219,17 +402,32 @@ class ChatGPTCrawler():
              "required": True}
         ]
     )
-    def visit_url(self, url):
-        if url in self.web_cache:
+    async def visit_url(self, url):
+        # variants of the same url (fragments, query order, ...) share one cache entry
+        cache_key = canonicalize_url(url)
+        if cache_key in self.web_cache:
             if self.verbose:
                 print(f"Using cached version of url {url}")
-            return self.web_cache[url]
+            return self.web_cache[cache_key]
         if self.verbose:
             self.visited_url = url
-        self.change_state(url)
-        self.webcrawler.load_url(url)
-        clean_html = self.webcrawler.get_cleaned_html()
-        self.web_cache[url] = clean_html
+        # cleaning is CPU bound, so keep it off the event loop
+        loop = asyncio.get_running_loop()
+        clean_html = self.page_cache.get(cache_key) if self.page_cache is not None else None
+        if clean_html is None:
+            self.change_state(url)
+            html_content = await self.webcrawler.load_url_async(url)
+            clean_html = await loop.run_in_executor(None, clean_html_content, html_content, url)
+            if self.page_cache is not None:
+                self.page_cache.set(cache_key, clean_html, expire=WEB_CACHE_EXPIRE)
+        clean_html = await loop.run_in_executor(None, self._shrink_html, clean_html)
+        self.web_cache[cache_key] = clean_html
+        return clean_html
+
+    def _shrink_html(self, clean_html):
+        clean_html = extract_contact_blocks(clean_html)
+        if self.max_html_tokens is not None:
+            clean_html = truncate_tokens(self.model, clean_html, self.max_html_tokens)
         return clean_html
 
     @register_tool(
@@ -274,7 +472,7 @@ class ChatGPTCrawler():
         self.contacts.append(contact)
         msg = f"Successfully saved contact: {contact}"
         if self.verbose:
-            logging.info(msg)
+            logging.info("%s", msg)
         return msg
 
     """
@@ -1,3 +1,10 @@
+import asyncio
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+import aiohttp
+import lxml.html
+from lxml.etree import ParserError
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
@@ -5,6 +12,189 @@ import re
 from urllib.parse import urljoin
 from bs4 import BeautifulSoup, NavigableString
 
+# pages with less visible text than this are assumed to be rendered by JavaScript
+MIN_STATIC_TEXT_LENGTH = 500
+# empty mount points of single page apps and 'please enable javascript' notices
+SPA_MOUNT_POINTS = '//div[@id="root" or @id="app" or @id="__next"][not(*) and not(normalize-space())]'
+JAVASCRIPT_NOTICE = re.compile(r'enable javascript', re.IGNORECASE)
+XML_DECLARATION = re.compile(r'^\s*<\?xml[^>]*\?>')
+
+# emails, phone numbers and titles that mark the contact details of a person
+CONTACT_PATTERN = re.compile(
+    r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+'
+    r'|(?:\+|\b0)\d[\d /()-]{5,}\d'
+    r'|\b(?:Dr\.|Prof\.|MdB|MdL|MdHB|Vorsitzende[rn]?|Sprecher(?:in)?)'
+)
+# elements a text near a contact detail is kept with, the nearest one around the text is kept as a whole
+CONTACT_BLOCK_TAGS = [
+    'address', 'article', 'dd', 'div', 'dt', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'li', 'p', 'section', 'span', 'td', 'th',
+]
+
+_session = None  # aiohttp session shared by all WebCrawlers, see _get_session()
+
+
+def _get_session():
+    """
+    Return the shared aiohttp session, creating it on first use so it belongs to the running event loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=50),
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+    return _session
+
+
+async def close_session():
+    """
+    Close the shared aiohttp session.
+    """
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def fetch_static_html(url):
+    """
+    Fetch the HTML of a web page with a plain HTTP GET request.
+
+    Args:
+        url (str): URL of the web page.
+
+    Returns:
+        str: HTML content of the web page, or None if it could not be fetched as HTML.
+    """
+    try:
+        async with _get_session().get(url) as response:
+            if response.status != 200 or 'html' not in response.content_type:
+                return None
+            return await response.text(errors='replace')
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+
+
+def needs_browser(html_content):
+    """
+    Check if a page fetched without a browser is probably rendered by JavaScript.
+
+    Args:
+        html_content (str): HTML content of the web page.
+
+    Returns:
+        bool: True if the page should be loaded with Selenium instead.
+    """
+    try:
+        # lxml refuses str input that starts with an XML encoding declaration
+        document = lxml.html.fromstring(XML_DECLARATION.sub('', html_content, count=1))
+    except ParserError:
+        return True
+    # a <noscript> banner is only shown without JavaScript and says nothing about the page itself
+    for element in document.xpath('//script|//style|//noscript'):
+        element.drop_tree()
+    if document.xpath(SPA_MOUNT_POINTS):
+        return True
+    text = ' '.join(document.text_content().split())
+    return bool(JAVASCRIPT_NOTICE.search(text)) or len(text) < MIN_STATIC_TEXT_LENGTH
+
+
+def clean_html_content(html_content, base_url):
+    """
+    Clean the HTML of a web page, keeping only elements that contain
+    visible text or have subelements with visible text.
+
+    Args:
+        html_content (str): HTML content to clean.
+        base_url (str): URL relative links are resolved against.
+
+    Returns:
+        str: Cleaned HTML content of the web page.
+    """
+    # Ensure the content is treated as UTF-8
+    html_content = html_content.encode('utf-8', errors='replace').decode('utf-8', errors='replace')
+
+    # Parse the HTML with the C based lxml parser
+    soup = BeautifulSoup(html_content, 'lxml')
+
+    # Remove script, style elements, and images
+    for unwanted_tag in soup(['script', 'style', 'img']):
+        unwanted_tag.decompose()
+
+    # Walk the tree once bottom up: in reversed document order every child comes before
+    # its parent, so an element already knows if it contains visible text when it is reached
+    with_text = set()  # ids of the elements containing visible text
+    without_text = []
+    for element in reversed(list(soup.descendants)):
+        if isinstance(element, NavigableString):
+            if element.strip() != '':
+                with_text.add(id(element.parent))
+            continue
+
+        # Remove all attributes except href and make all hrefs in <a> tags absolute
+        href = element.attrs.get('href')
+        if href is None:
+            element.attrs = {}
+        elif element.name == 'a':
+            element.attrs = {'href': urljoin(base_url, href)}
+        else:
+            element.attrs = {'href': href}
+
+        if id(element) in with_text:
+            with_text.add(id(element.parent))
+        else:
+            without_text.append(element)
+
+    # Remove elements without visible text or subelements with visible text,
+    # elements inside a removed element are removed together with it
+    for element in without_text:
+        if element.parent is soup or id(element.parent) in with_text:
+            element.decompose()
+
+    # Return the cleaned HTML as a string
+    return str(soup)
+
+
+def extract_contact_blocks(html_content, context=200):
+    """
+    Reduce cleaned HTML to the blocks around contact details (emails, phone numbers, titles)
+    and the links needed to navigate further.
+
+    Args:
+        html_content (str): Cleaned HTML content, see WebCrawler.get_cleaned_html().
+        context (int): Number of text characters around a contact detail whose blocks are kept.
+
+    Returns:
+        str: The extracted blocks, or the unchanged HTML if it contains no contact details.
+    """
+    soup = BeautifulSoup(html_content, 'lxml')
+    # every text of the page (without comments etc.) and its position in all texts joined by spaces
+    texts = [text for text in soup.find_all(string=True) if type(text) is NavigableString and text.strip()]
+    starts = list(accumulate((len(text) + 1 for text in texts), initial=0))
+    matches = list(CONTACT_PATTERN.finditer(' '.join(texts)))
+    if not matches:
+        return html_content
+
+    # every text within the context of a match keeps its nearest block, or itself if it has none
+    kept = set()
+    for match in matches:
+        first = max(bisect_right(starts, match.start() - context) - 1, 0)
+        last = bisect_left(starts, match.end() + context)
+        for text in texts[first:last]:
+            kept.add(id(text.find_parent(CONTACT_BLOCK_TAGS) or text))
+
+    emitted = set()
+    blocks = []
+    for element in soup.descendants:
+        if any(id(parent) in emitted for parent in element.parents):
+            continue
+        # links outside the kept blocks (e.g. menus) are needed to navigate further
+        if id(element) in kept or element.name == 'a':
+            emitted.add(id(element))
+            blocks.append(str(element))
+    return '\n'.join(blocks)
+
 
 class WebCrawler:
     """
@@ -16,7 +206,18 @@ class WebCrawler:
         Initialize the WebCrawler instance.
         """
         self.url = None  # URL of the web page to be crawled.
-        self.driver = self._get_driver(headless=headless)  # Selenium WebDriver instance.
+        self.headless = headless
+        self._driver = None  # Selenium WebDriver instance, started on first use.
+        self._browser_lock = asyncio.Lock()  # the browser can only show one page at a time
+
+    @property
+    def driver(self):
+        """
+        The Selenium WebDriver instance, it is only started when a page actually needs a browser.
+        """
+        if self._driver is None:
+            self._driver = self._get_driver(headless=self.headless)
+        return self._driver
 
     def _get_driver(self, headless=True):
         """
@@ -38,6 +239,49 @@ class WebCrawler:
         self.url = url
         self.driver.get(self.url)
 
+    async def load_url_async(self, url):
+        """
+        Load the web page at the given URL with a plain HTTP request and only fall back
+        to Selenium if the page seems to be rendered by JavaScript.
+
+        Args:
+            url (str): URL of the web page to be loaded.
+
+        Returns:
+            str: HTML content of the web page.
+        """
+        html_content = await fetch_static_html(url)
+        if html_content is None or needs_browser(html_content):
+            html_content = await self.load_url_in_browser(url)
+        return html_content
+
+    async def load_url_in_browser(self, url):
+        """
+        Load the web page at the given URL with Selenium without blocking the event loop.
+
+        Args:
+            url (str): URL of the web page to be loaded.
+
+        Returns:
+            str: HTML content of the web page.
+        """
+        async with self._browser_lock:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(None, self._load_with_browser, url)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # the thread keeps driving the browser, so only release the lock once it is done
+                await asyncio.wait([future])
+                raise
+
+    def _load_with_browser(self, url):
+        """
+        Load the web page at the given URL with Selenium and return its HTML content.
+        """
+        self.load_url(url)
+        return self.driver.page_source
+
     def find_links(self, pattern=r'.*'):
         """
         Find all links on the web page that match a given regular expression pattern.
@@ -77,55 +321,103 @@ class WebCrawler:
                 matching_links.append((text, href))
         return matching_links
 
-    def get_cleaned_html(self):
+    def get_cleaned_html(self, html_content=None, base_url=None):
         """
-        Get the cleaned HTML of the current web page, keeping only elements that contain
+        Get the cleaned HTML of a web page, keeping only elements that contain
         visible text or have subelements with visible text.
 
+        Args:
+            html_content (str): HTML content to clean.
+                default: None (the page currently loaded in the browser)
+            base_url (str): URL relative links are resolved against.
+                default: None (the URL of the page loaded in the browser)
+
         Returns:
             str: Cleaned HTML content of the web page.
         """
         # Get the current page source
-        html_content = self.driver.page_source
+        if html_content is None:
+            html_content = self.driver.page_source
+        if base_url is None:
+            base_url = self.url
 
-        # Ensure the content is treated as UTF-8
-        html_content = html_content.encode('utf-8', errors='replace').decode('utf-8', errors='replace')
+        return clean_html_content(html_content, base_url)
 
-        # Parse the HTML with BeautifulSoup
-        soup = BeautifulSoup(html_content, 'html.parser')
+    def close(self):
+        """
+        Close the Selenium WebDriver instance.
+        """
+        if self._driver is not None:
+            self._driver.quit()
+            self._driver = None
 
-        # Remove script, style elements, and images
-        for unwanted_tag in soup(['script', 'style', 'img']):
-            unwanted_tag.decompose()
 
-        # Remove all attributes except href in <a> tags
-        for tag in soup.find_all(True):
-            tag.attrs = {key: tag.attrs[key] for key in tag.attrs if key == 'href'}
+class WebCrawlerPool:
+    """
+    A bounded pool of WebCrawler instances. Static pages are fetched without a browser,
+    only pages rendered by JavaScript take a WebCrawler from the pool while they are loaded.
+    """
+    def __init__(self, size=8, headless=True):
+        """
+        Initialize the WebCrawlerPool instance. Browsers are only started when they are needed.
 
-        # Function to check if an element contains visible text
-        def contains_visible_text(element):
-            if isinstance(element, NavigableString):
-                return element.strip() != ''
-            return any(contains_visible_text(child) for child in element.children)
+        Args:
+            size (int): Maximum number of WebCrawler instances.
+            headless (bool): Whether the browsers run in headless mode.
+        """
+        self.size = size
+        self.headless = headless
+        self._crawlers = []  # every WebCrawler started by the pool
+        self._idle = asyncio.Queue()  # WebCrawlers that are currently not in use
 
-        # Remove elements without visible text or subelements with visible text
-        for element in soup.find_all(True):
-            if not contains_visible_text(element):
-                element.decompose()
+    async def get(self):
+        """
+        Take a WebCrawler from the pool. Starts a new one while the pool is not full,
+        otherwise waits until one is handed back with put().
 
-        # make all hrefs absolute
-        for link in soup.find_all('a'):
-            if 'href' in link.attrs:
-                link['href'] = urljoin(self.url, link['href'])
+        Returns:
+            WebCrawler: A crawler for exclusive use until it is put back.
+        """
+        if self._idle.empty() and len(self._crawlers) < self.size:
+            # cheap, the WebCrawler only starts its browser when a page needs it
+            crawler = WebCrawler(headless=self.headless)
+            self._crawlers.append(crawler)
+            return crawler
+        return await self._idle.get()
 
-        # Return the cleaned HTML as a string
-        return str(soup)
+    async def load_url_async(self, url):
+        """
+        Load the web page at the given URL like WebCrawler.load_url_async(), using a
+        WebCrawler of the pool if the page needs a browser.
+
+        Args:
+            url (str): URL of the web page to be loaded.
+
+        Returns:
+            str: HTML content of the web page.
+        """
+        html_content = await fetch_static_html(url)
+        if html_content is None or needs_browser(html_content):
+            crawler = await self.get()
+            try:
+                html_content = await crawler.load_url_in_browser(url)
+            finally:
+                self.put(crawler)
+        return html_content
+
+    def put(self, crawler):
+        """
+        Hand a WebCrawler taken with get() back to the pool.
+        """
+        self._idle.put_nowait(crawler)
 
     def close(self):
         """
-        Close the Selenium WebDriver instance.
+        Close every WebCrawler started by the pool.
         """
-        self.driver.quit()
+        for crawler in self._crawlers:
+            crawler.close()
+        self._crawlers = []
 
 
 if __name__ == "__main__":
@@ -0,0 +1,20 @@
+from aiolimiter import AsyncLimiter
+
+from .tokens import count_message_tokens
+
+# limits of the OpenAI organisation, shared by every ChatGPTCrawler in the process
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 80000
+
+request_limiter = AsyncLimiter(REQUESTS_PER_MINUTE, time_period=60)
+token_limiter = AsyncLimiter(TOKENS_PER_MINUTE, time_period=60)
+
+
+async def throttle(model, messages):
+    """
+    Waits until a request with the given messages fits into the requests and tokens per minute limits
+    """
+    await request_limiter.acquire()
+    estimated_tokens = count_message_tokens(model, messages)
+    # a single prompt larger than the bucket can never be acquired, so cap it at the bucket size
+    await token_limiter.acquire(min(estimated_tokens, token_limiter.max_rate))
@@ -0,0 +1,42 @@
+from functools import lru_cache
+
+import tiktoken
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """
+    Returns the tiktoken encoding of the given model, unknown models fall back to cl100k_base
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(model, text):
+    """
+    Counts the tokens of a text for the given model
+    """
+    # crawled pages may contain strings like '<|endoftext|>', treat them as plain text
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def count_message_tokens(model, messages):
+    """
+    Estimates the prompt tokens of a list of chat messages
+    """
+    return sum(count_tokens(model, message.get("content") or "") for message in messages)
+
+
+def truncate_tokens(model, text, max_tokens):
+    """
+    Cuts a text down to at most max_tokens tokens of the given model
+
+    Returns: the (possibly) shortened text
+    """
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
@@ -0,0 +1,70 @@
+from src.crawler import extract_contact_blocks, needs_browser
+
+FILLER = '<p>lorem ipsum</p>' * 50
+
+
+def test_extract_contact_blocks_keeps_div_based_contact_cards():
+    card = (
+        '<div><div>Max Mustermann</div><span>Sprecher für Verkehr</span>'
+        '<div>Tel. 040 1234567</div><a href="mailto:max@x.de">max@x.de</a></div>'
+    )
+    html = f'<html><body><p>Willkommen</p>{FILLER}{card}{FILLER}<p>Impressum</p></body></html>'
+
+    extracted = extract_contact_blocks(html)
+
+    assert card in extracted
+    assert 'Willkommen' not in extracted
+    assert 'Impressum' not in extracted
+
+
+def test_extract_contact_blocks_keeps_cards_without_email():
+    card = '<div><dt>Erika Musterfrau</dt><dd>Tel. +49 40 7654321</dd></div>'
+    html = f'<html><body>{FILLER}{card}</body></html>'
+
+    extracted = extract_contact_blocks(html)
+
+    assert 'Erika Musterfrau' in extracted
+    assert '+49 40 7654321' in extracted
+
+
+def test_extract_contact_blocks_keeps_navigation_links():
+    html = (
+        '<html><body><ul><li><a href="https://x.de/fraktion">Fraktion</a></li></ul>'
+        f'{FILLER}<p>Kontakt: info@x.de</p></body></html>'
+    )
+
+    extracted = extract_contact_blocks(html)
+
+    assert '<a href="https://x.de/fraktion">Fraktion</a>' in extracted
+    assert '<p>Kontakt: info@x.de</p>' in extracted
+
+
+def test_extract_contact_blocks_returns_pages_without_contacts_unchanged():
+    html = f'<html><body>{FILLER}</body></html>'
+
+    assert extract_contact_blocks(html) == html
+
+
+def test_needs_browser_parses_pages_with_xml_declaration():
+    html = (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml"><body>'
+        f'{FILLER}<p>Tel. 040 1234567</p></body></html>'
+    )
+
+    assert not needs_browser(html)
+
+
+def test_needs_browser_ignores_noscript_banners():
+    html = (
+        '<html><body><noscript>Please enable JavaScript for the best experience.</noscript>'
+        f'{FILLER}<p>Tel. 040 1234567</p></body></html>'
+    )
+
+    assert not needs_browser(html)
+
+
+def test_needs_browser_detects_empty_app_root():
+    html = f'<html><body><div id="root"></div><noscript>{FILLER}</noscript></body></html>'
+
+    assert needs_browser(html)